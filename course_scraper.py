@@ -7,17 +7,162 @@ uses Google Gemini AI to parse the HTML content, and sends email notifications
 via Mailjet when new courses are detected.
 """
 
+import functools
+import hashlib
 import json
 import os
+import re
 import smtplib
 import sys
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import google.generativeai as genai
+from selectolax.lexbor import LexborHTMLParser
+
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib codec when orjson is unavailable
+    orjson = None
+
+_TARGET_URL = "https://www.freizeitbad-molzberg.com/anfangerkurs"
+_HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+_TIMEOUT = 30
+_MAILJET_SMTP_HOST = 'in-v3.mailjet.com'
+_MAILJET_SMTP_PORT = 587
+
+_GEMINI_MODEL = 'gemini-2.5-flash'
+
+# Gemini results are cached per model, instructions and HTML content hash to skip redundant LLM calls
+_GEMINI_CACHE_MAX_ENTRIES = 32
+_GEMINI_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Static extraction instructions, configured once as the model's system instruction
+_SYSTEM_INSTRUCTION = """\
+Please analyze the HTML content from a swim course website provided by the user and extract all available swim courses.
+
+Return the result as a valid JSON array containing objects with the following structure:
+[
+    {
+        "course_id": "",
+        "price": "",
+        "date_time": "",
+        "location": "",
+        "participants": "",
+        "booking_status": "",
+        "booking_link": ""
+    }
+]
+
+Important:
+- The "course_id" field should be a unique identifier extracted from the course (like "KINDERKURS KSK00-00")
+- Extract exact price format including currency symbol (like "10,00 €")
+- Include full date and time information in "date_time" field
+- Include location/pool information in "location" field
+- Extract participant limits in "participants" field
+- Include booking instructions or status in "booking_status" field
+- Include any PDF form links or registration links in "booking_link" field
+- If certain information is not available, use null or an empty string
+- Only return valid JSON, no additional text or explanation
+- Focus on actual swim courses for beginners/anfänger and children/kinder
+- Under no circumstances should you make up data.
+"""
+
+# Markdown code fence Gemini sometimes wraps around its JSON answer
+# (the closing fence is optional so truncated answers are still unwrapped)
+_FENCE_RE = re.compile(r'^\s*```(?:json)?\s*\n?(.*?)(?:\n?```)?\s*$', re.DOTALL)
+
+# Notification email templates
+_HEADER_TEMPLATE = (
+    "New swim courses have been detected at Freizeitbad Molzberg!\n\n"
+    "Website: {url}\n\n"
+    "New Courses:\n"
+    + "=" * 50 + "\n"
+)
+_COURSE_TEMPLATE = "{i}. Course ID: {course_id}\n"
+_FOOTER = (
+    "\nPlease visit the website to register for the courses.\n"
+    "\n---\nThis is an automated notification from the Molzberg Monitor."
+)
+_COURSE_FIELDS = (
+    ('price', 'Price'),
+    ('date_time', 'Schedule'),
+    ('location', 'Location'),
+    ('participants', 'Participants'),
+    ('booking_status', 'Booking'),
+    ('booking_link', 'Registration Form'),
+)
+
+
+def _json_loads(data):
+    """Decode JSON from str or bytes, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(data) -> bytes:
+    """Encode data as indented UTF-8 JSON bytes, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+
+
+def _json_line(data) -> bytes:
+    """Encode data as a single newline-terminated line of UTF-8 JSON"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(data, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+def _write_json_atomic(path: Path, data):
+    """Write data as JSON to a temporary file and atomically move it into place"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + '.tmp')
+    tmp_path.write_bytes(_json_dumps(data))
+    os.replace(tmp_path, path)
+
+
+def _strip_code_fence(content: str) -> str:
+    """Remove a markdown code fence wrapped around a Gemini answer, if present"""
+    match = _FENCE_RE.match(content)
+    return match.group(1) if match else content
+
+
+def _gemini_cache_key(html_content: str) -> str:
+    """Hash the model, instructions and HTML content that determine a Gemini result"""
+    digest = hashlib.sha256()
+    for part in (_GEMINI_MODEL, _SYSTEM_INSTRUCTION, html_content):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _extract_course_html(html_content: str) -> str:
+    """Reduce page HTML to the main content without scripts, styles or inline graphics"""
+    tree = LexborHTMLParser(html_content)
+    tree.strip_tags(['script', 'style', 'svg', 'noscript'])
+    for node in (tree.css_first('main'), tree.css_first('#content'), tree.body):
+        # Empty or graphics-only containers would hide the courses from Gemini
+        if node is not None and node.text(strip=True):
+            return node.html
+    return html_content
+
+
+@functools.lru_cache(maxsize=64)
+def _course_template(present_fields: frozenset) -> str:
+    """Build the email template for a course with the given populated fields"""
+    return _COURSE_TEMPLATE + "".join(
+        f"   {label}: {{{field}}}\n" for field, label in _COURSE_FIELDS if field in present_fields
+    )
 
 
 class CourseScraperError(Exception):
@@ -29,8 +174,16 @@ class CourseScraper:
     """Main class for scraping and managing swim course data"""
     
     def __init__(self, init_gemini=True):
-        self.target_url = "https://www.freizeitbad-molzberg.com/anfangerkurs"
-        self.state_file = Path("state/known_courses.json")
+        self.target_url = _TARGET_URL
+        self.state_file = Path("state/known_courses.jsonl")
+        self.gemini_cache_file = Path("state/gemini_cache.json")
+        self.gemini_cache_hits = 0
+        self._known_ids = frozenset()
+        self.http_cache_file = Path("state/http_cache.json")
+        self.http_cache = {}
+        self._pending_http_cache = {}
+        self._smtp = None
+        self.session = self.create_session()
         if init_gemini:
             self.setup_gemini()
         
@@ -41,76 +194,157 @@ class CourseScraper:
             raise CourseScraperError("GEMINI_API_KEY environment variable not set")
         
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        self.model = genai.GenerativeModel(_GEMINI_MODEL, system_instruction=_SYSTEM_INSTRUCTION)
+    
+    def create_session(self) -> requests.Session:
+        """Create an HTTP session with connection pooling and retries"""
+        session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries)
+        session.mount('https://', adapter)
+        session.headers.update(_HTTP_HEADERS)
+        return session
+    
+    def load_http_cache(self) -> Dict[str, Any]:
+        """Load HTTP validators and content hash from the last successful run"""
+        try:
+            if self.http_cache_file.exists():
+                with open(self.http_cache_file, 'rb') as f:
+                    http_cache = _json_loads(f.read())
+                if not isinstance(http_cache, dict):
+                    print("Warning: Ignoring HTTP cache that is not a JSON object")
+                    return {}
+                return http_cache
+            return {}
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Warning: Could not load HTTP cache: {e}")
+            return {}
     
-    def fetch_website_content(self) -> str:
-        """Fetch HTML content from the target website"""
+    def _known_state_fingerprint(self) -> Optional[str]:
+        """Hash the known courses state file so edits to it invalidate the HTTP cache"""
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            response = requests.get(self.target_url, headers=headers, timeout=30)
+            return hashlib.sha256(self.state_file.read_bytes()).hexdigest()
+        except IOError:
+            return None
+    
+    def save_http_cache(self):
+        """Save HTTP validators of the last fetch once its content has been processed"""
+        if not self._pending_http_cache:
+            return
+        http_cache = {**self._pending_http_cache, 'known_state_sha256': self._known_state_fingerprint()}
+        if http_cache == self.http_cache:
+            return
+        try:
+            _write_json_atomic(self.http_cache_file, http_cache)
+            self.http_cache = http_cache
+        except IOError as e:
+            print(f"Warning: Could not save HTTP cache: {e}")
+    
+    def fetch_website_content(self) -> Optional[str]:
+        """Fetch HTML content from the target website, or None if it is not modified"""
+        self.http_cache = self.load_http_cache()
+        if self.http_cache and self.http_cache.get('known_state_sha256') != self._known_state_fingerprint():
+            print("Known courses state changed since last run, ignoring HTTP cache")
+            self.http_cache = {}
+        headers = {}
+        if self.http_cache.get('etag'):
+            headers['If-None-Match'] = self.http_cache['etag']
+        if self.http_cache.get('last_modified'):
+            headers['If-Modified-Since'] = self.http_cache['last_modified']
+        
+        try:
+            response = self.session.get(self.target_url, headers=headers, timeout=_TIMEOUT)
+            if response.status_code == 304:
+                return None
             response.raise_for_status()
-            return response.text
         except requests.RequestException as e:
             raise CourseScraperError(f"Failed to fetch website content: {e}")
+        
+        self._pending_http_cache = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'html_sha256': hashlib.sha256(response.content).hexdigest(),
+        }
+        return self._decode_content(response)
+    
+    @staticmethod
+    def _decode_content(response: requests.Response) -> str:
+        """Decode the response body as UTF-8 unless the server declares a charset"""
+        encoding = 'utf-8'
+        if 'charset=' in response.headers.get('Content-Type', '').lower() and response.encoding:
+            encoding = response.encoding
+        try:
+            return response.content.decode(encoding, errors='replace')
+        except LookupError:
+            return response.content.decode('utf-8', errors='replace')
+    
+    @staticmethod
+    def _is_valid_gemini_cache_entry(entry: Any) -> bool:
+        """Check that a Gemini cache entry has a usage timestamp and a valid course list"""
+        return (
+            isinstance(entry, dict)
+            and isinstance(entry.get('last_used'), (int, float))
+            and isinstance(entry.get('courses'), list)
+            and all(isinstance(course, dict) and 'course_id' in course for course in entry['courses'])
+        )
+    
+    def load_gemini_cache(self) -> Dict[str, Any]:
+        """Load cached Gemini results, dropping invalid entries and those unused for longer than the TTL"""
+        try:
+            if self.gemini_cache_file.exists():
+                with open(self.gemini_cache_file, 'rb') as f:
+                    cache = _json_loads(f.read())
+                cutoff = time.time() - _GEMINI_CACHE_TTL_SECONDS
+                return {
+                    html_hash: entry for html_hash, entry in cache.items()
+                    if self._is_valid_gemini_cache_entry(entry) and entry['last_used'] >= cutoff
+                }
+            return {}
+        except (json.JSONDecodeError, IOError, AttributeError) as e:
+            print(f"Warning: Could not load Gemini cache: {e}")
+            return {}
+    
+    def save_gemini_cache(self, cache: Dict[str, Any]):
+        """Save Gemini results to the cache file, keeping only the most recently used entries"""
+        recent = sorted(cache.items(), key=lambda item: item[1]['last_used'], reverse=True)
+        try:
+            _write_json_atomic(self.gemini_cache_file, dict(recent[:_GEMINI_CACHE_MAX_ENTRIES]))
+        except IOError as e:
+            print(f"Warning: Could not save Gemini cache: {e}")
     
     def parse_courses_with_gemini(self, html_content: str) -> List[Dict[str, Any]]:
         """Use Gemini to parse HTML and extract course information"""
-        prompt = """
-        Please analyze the following HTML content from a swim course website and extract all available swim courses.
-        
-        Return the result as a valid JSON array containing objects with the following structure:
-        [
-            {
-                "course_id": "",
-                "price": "",
-                "date_time": "",
-                "location": "",
-                "participants": "",
-                "booking_status": "",
-                "booking_link": ""
-            }
-        ]
-        
-        Important:
-        - The "course_id" field should be a unique identifier extracted from the course (like "KINDERKURS KSK00-00")
-        - Extract exact price format including currency symbol (like "10,00 €")
-        - Include full date and time information in "date_time" field
-        - Include location/pool information in "location" field
-        - Extract participant limits in "participants" field
-        - Include booking instructions or status in "booking_status" field
-        - Include any PDF form links or registration links in "booking_link" field
-        - If certain information is not available, use null or an empty string
-        - Only return valid JSON, no additional text or explanation
-        - Focus on actual swim courses for beginners/anfänger and children/kinder
-        - Under no circumstances should you make up data.
-        
-        HTML Content:
-        """ + html_content
+        html_content = _extract_course_html(html_content)
+        html_hash = _gemini_cache_key(html_content)
+        cache = self.load_gemini_cache()
+        entry = cache.get(html_hash)
+        if entry is not None:
+            self.gemini_cache_hits += 1
+            print("HTML content unchanged, using cached Gemini result")
+            entry['last_used'] = time.time()
+            self.save_gemini_cache(cache)
+            return entry['courses']
         
         try:
-            response = self.model.generate_content(prompt)
-            content = response.text.strip()
+            response = self.model.generate_content(html_content)
+            if not response.candidates:
+                raise ValueError("Response contains no candidates")
             
-            # Remove markdown code blocks if present
-            if content.startswith('```json'):
-                content = content[7:]
-            if content.startswith('```'):
-                content = content[3:]
-            if content.endswith('```'):
-                content = content[:-3]
+            # Read the text parts directly instead of going through response.text
+            content = "".join(part.text for part in response.candidates[0].content.parts).strip()
             
-            # Parse JSON
-            courses = json.loads(content.strip())
+            # Remove markdown code blocks if present, then parse JSON
+            courses = _json_loads(_strip_code_fence(content).strip())
             
             # Validate structure
             if not isinstance(courses, list):
                 raise ValueError("Response is not a list")
             
-            for course in courses:
-                if not isinstance(course, dict) or 'course_id' not in course:
-                    raise ValueError("Invalid course structure")
+            if not all(isinstance(course, dict) and 'course_id' in course for course in courses):
+                raise ValueError("Invalid course structure")
+            
+            cache[html_hash] = {'courses': courses, 'last_used': time.time()}
+            self.save_gemini_cache(cache)
             
             return courses
             
@@ -119,38 +353,121 @@ class CourseScraper:
         except Exception as e:
             raise CourseScraperError(f"Gemini API error: {e}")
     
+    def _iter_known_courses(self) -> Iterator[Dict[str, Any]]:
+        """Stream courses from the JSON Lines state file, skipping unreadable lines"""
+        if not self.state_file.exists():
+            return
+        with open(self.state_file, 'rb') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    course = _json_loads(line)
+                except ValueError as e:
+                    print(f"Warning: Skipping invalid line {line_number} in {self.state_file}: {e}")
+                    continue
+                if not isinstance(course, dict):
+                    print(f"Warning: Skipping non-object line {line_number} in {self.state_file}")
+                    continue
+                yield course
+    
     def load_known_courses(self) -> List[Dict[str, Any]]:
         """Load previously known courses from state file"""
         try:
-            if self.state_file.exists():
-                with open(self.state_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return []
-        except (json.JSONDecodeError, IOError) as e:
+            courses = list(self._iter_known_courses())
+        except IOError as e:
             print(f"Warning: Could not load known courses: {e}")
+            self._known_ids = frozenset()
             return []
+        self._known_ids = self._index_course_ids(courses)
+        return courses
     
-    def save_known_courses(self, courses: List[Dict[str, Any]]):
-        """Save courses to state file"""
+    def load_known_course_ids(self) -> frozenset:
+        """Load the IDs of previously known courses without keeping the courses"""
+        try:
+            self._known_ids = self._index_course_ids(self._iter_known_courses())
+        except IOError as e:
+            print(f"Warning: Could not load known courses: {e}")
+            self._known_ids = frozenset()
+        return self._known_ids
+    
+    def save_known_courses(self, new_courses: List[Dict[str, Any]]):
+        """Append newly detected courses to the state file"""
         try:
             self.state_file.parent.mkdir(parents=True, exist_ok=True)
-            with open(self.state_file, 'w', encoding='utf-8') as f:
-                json.dump(courses, f, indent=2, ensure_ascii=False)
+            lines = [_json_line(course) for course in new_courses]
+            with open(self.state_file, 'a+b') as f:
+                if f.tell() > 0:
+                    # Start on a fresh line if a previous append was cut short
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        lines.insert(0, b'\n')
+                f.write(b''.join(lines))
+            self._known_ids = self._known_ids | self._index_course_ids(new_courses)
         except IOError as e:
             raise CourseScraperError(f"Failed to save known courses: {e}")
     
-    def find_new_courses(self, current_courses: List[Dict[str, Any]], 
-                        known_courses: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Compare current courses with known courses to find new ones"""
-        known_ids = {course.get('course_id') for course in known_courses}
-        new_courses = []
-        
-        for course in current_courses:
-            course_id = course.get('course_id')
-            if course_id and course_id not in known_ids:
-                new_courses.append(course)
+    @staticmethod
+    def _index_course_ids(courses: Iterable[Dict[str, Any]]) -> frozenset:
+        """Build a set of the course IDs present in a course list"""
+        return frozenset(cid for course in courses if (cid := course.get('course_id')))
+    
+    def find_new_courses(self, current_courses: List[Dict[str, Any]],
+                        known_courses: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """Compare current courses with known (by default the last loaded) courses to find new ones"""
+        known_ids = self._known_ids if known_courses is None else self._index_course_ids(known_courses)
+        return [
+            course for course in current_courses
+            if (cid := course.get('course_id')) and cid not in known_ids
+        ]
+    
+    def _get_smtp(self, username: str, password: str) -> smtplib.SMTP:
+        """Return an authenticated Mailjet SMTP connection, reusing a live one"""
+        if self._smtp is not None:
+            try:
+                self._smtp.noop()
+                return self._smtp
+            except smtplib.SMTPServerDisconnected:
+                self._smtp = None
         
-        return new_courses
+        server = smtplib.SMTP(_MAILJET_SMTP_HOST, _MAILJET_SMTP_PORT)
+        try:
+            server.starttls()
+            server.login(username, password)
+        except smtplib.SMTPException:
+            server.close()
+            raise
+        self._smtp = server
+        return server
+    
+    def _close_smtp(self):
+        """Close the cached SMTP connection, if any"""
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except smtplib.SMTPException:
+                self._smtp.close()
+            self._smtp = None
+    
+    def close(self):
+        """Release the SMTP connection and HTTP session"""
+        self._close_smtp()
+        self.session.close()
+    
+    def _render_subject(self, new_courses: List[Dict[str, Any]]) -> str:
+        """Render the notification email subject"""
+        return f"🏊 New Swim Courses Available at Freizeitbad Molzberg ({len(new_courses)} found)"
+    
+    def _render_body(self, new_courses: List[Dict[str, Any]]) -> str:
+        """Render the plain-text notification email body"""
+        lines = [_HEADER_TEMPLATE.format(url=self.target_url)]
+        for i, course in enumerate(new_courses, 1):
+            fields = {field: course[field] for field, _ in _COURSE_FIELDS if course.get(field)}
+            lines.append(_course_template(frozenset(fields)).format(
+                i=i, course_id=course.get('course_id', 'Unknown Course'), **fields
+            ))
+        lines.append(_FOOTER)
+        return "\n".join(lines)
     
     def send_notification(self, new_courses: List[Dict[str, Any]]):
         """Send email notification via Mailjet SMTP"""
@@ -163,50 +480,22 @@ class CourseScraper:
         if not all([mailjet_public, mailjet_private, sender_email, recipient_email]):
             raise CourseScraperError("Missing required email configuration environment variables")
         
-        # Create email content
-        subject = f"🏊 New Swim Courses Available at Freizeitbad Molzberg ({len(new_courses)} found)"
-        
-        body = "New swim courses have been detected at Freizeitbad Molzberg!\n\n"
-        body += f"Website: {self.target_url}\n\n"
-        body += "New Courses:\n"
-        body += "=" * 50 + "\n\n"
-        
-        for i, course in enumerate(new_courses, 1):
-            body += f"{i}. Course ID: {course.get('course_id', 'Unknown Course')}\n"
-            if course.get('price'):
-                body += f"   Price: {course['price']}\n"
-            if course.get('date_time'):
-                body += f"   Schedule: {course['date_time']}\n"
-            if course.get('location'):
-                body += f"   Location: {course['location']}\n"
-            if course.get('participants'):
-                body += f"   Participants: {course['participants']}\n"
-            if course.get('booking_status'):
-                body += f"   Booking: {course['booking_status']}\n"
-            if course.get('booking_link'):
-                body += f"   Registration Form: {course['booking_link']}\n"
-            body += "\n"
-        
-        body += "\nPlease visit the website to register for the courses.\n"
-        body += "\n---\nThis is an automated notification from the Molzberg Monitor."
-        
         # Create email message
         msg = MIMEMultipart()
         msg['From'] = sender_email
         msg['To'] = recipient_email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain', 'utf-8'))
+        msg['Subject'] = self._render_subject(new_courses)
+        msg.attach(MIMEText(self._render_body(new_courses), 'plain', 'utf-8'))
         
         # Send email via Mailjet SMTP
         try:
-            with smtplib.SMTP('in-v3.mailjet.com', 587) as server:
-                server.starttls()
-                server.login(mailjet_public, mailjet_private)
-                server.send_message(msg)
+            server = self._get_smtp(mailjet_public, mailjet_private)
+            server.send_message(msg)
             
             print(f"Email notification sent successfully to {recipient_email}")
             
         except smtplib.SMTPException as e:
+            self._close_smtp()
             raise CourseScraperError(f"Failed to send email notification: {e}")
     
     def run(self):
@@ -217,8 +506,16 @@ class CourseScraper:
             # Step 1: Fetch website content
             print("Fetching website content...")
             html_content = self.fetch_website_content()
+            if html_content is None:
+                print("Website content not modified since last run (HTTP 304). Nothing to do.")
+                return False
             print(f"Fetched {len(html_content)} characters of HTML content")
             
+            if self._pending_http_cache['html_sha256'] == self.http_cache.get('html_sha256'):
+                print("Website content unchanged since last run. Nothing to do.")
+                self.save_http_cache()
+                return False
+            
             # Step 2: Parse courses with Gemini
             print("Analyzing content with Gemini AI...")
             current_courses = self.parse_courses_with_gemini(html_content)
@@ -226,11 +523,11 @@ class CourseScraper:
             
             # Step 3: Load known courses
             print("Loading previously known courses...")
-            known_courses = self.load_known_courses()
-            print(f"Loaded {len(known_courses)} known courses")
+            known_ids = self.load_known_course_ids()
+            print(f"Loaded {len(known_ids)} known courses")
             
             # Step 4: Find new courses
-            new_courses = self.find_new_courses(current_courses, known_courses)
+            new_courses = self.find_new_courses(current_courses)
             print(f"Detected {len(new_courses)} new courses")
             
             # Step 5: Send notification if new courses found
@@ -240,12 +537,13 @@ class CourseScraper:
                 
                 # Step 6: Update state file only when new course IDs are found
                 print("Updating known courses state...")
-                self.save_known_courses(current_courses)
+                self.save_known_courses(new_courses)
                 print("State file updated successfully")
             else:
                 print("No new courses detected. No notification sent.")
                 print("State file not updated (only updates when course IDs change)")
             
+            self.save_http_cache()
             print("Course scraper completed successfully!")
             return len(new_courses) > 0
             
@@ -260,7 +558,10 @@ class CourseScraper:
 def main():
     """Entry point for the script"""
     scraper = CourseScraper()
-    scraper.run()
+    try:
+        scraper.run()
+    finally:
+        scraper.close()
 
 
 if __name__ == "__main__":
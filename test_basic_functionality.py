@@ -4,7 +4,13 @@ Simple test to verify the basic functionality of the course scraper
 without requiring external API access.
 """
 
-import json
+import contextlib
+import tempfile
+import time
+from types import SimpleNamespace
+
+import requests
+import course_scraper
 from pathlib import Path
 import sys
 import os
@@ -12,7 +18,31 @@ import os
 # Add the script directory to the path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from course_scraper import CourseScraper
+from course_scraper import CourseScraper, _extract_course_html, _json_dumps, _json_line, _strip_code_fence
+
+_scraper = None
+
+def get_scraper():
+    """Return a scraper instance shared by all tests"""
+    global _scraper
+    if _scraper is None:
+        _scraper = CourseScraper(init_gemini=False)
+    return _scraper
+
+@contextlib.contextmanager
+def temporary_state(scraper):
+    """Point the scraper's state files at a temporary directory and restore all its attributes afterwards"""
+    saved = dict(vars(scraper))
+    with tempfile.TemporaryDirectory() as state_dir:
+        state_dir = Path(state_dir)
+        scraper.state_file = state_dir / "known_courses.jsonl"
+        scraper.gemini_cache_file = state_dir / "gemini_cache.json"
+        scraper.http_cache_file = state_dir / "http_cache.json"
+        try:
+            yield state_dir
+        finally:
+            vars(scraper).clear()
+            vars(scraper).update(saved)
 
 def test_state_management():
     """Test loading and saving of course state"""
@@ -40,14 +70,10 @@ def test_state_management():
         }
     ]
     
-    # Test state file path
-    test_state_file = Path("state/test_known_courses.json")
-    
-    # Create a test scraper instance
-    scraper = CourseScraper(init_gemini=False)
-    scraper.state_file = test_state_file
+    # Use temporary state files so tests never touch the real state directory
+    scraper = get_scraper()
     
-    try:
+    with temporary_state(scraper):
         # Test saving courses
         scraper.save_known_courses(test_courses)
         print("✓ Successfully saved test courses")
@@ -75,16 +101,183 @@ def test_state_management():
         assert len(new_courses) == 1
         assert new_courses[0]["course_id"] == "KINDERKURS_TEST_03"
         print("✓ Successfully identified new courses")
+
+def test_known_courses_append_only():
+    """Test appending to the JSON Lines state file and recovering from bad lines"""
+    print("\nTesting append-only course state...")
+    
+    scraper = get_scraper()
+    
+    with temporary_state(scraper):
+        # A second save appends instead of overwriting
+        scraper.save_known_courses([{"course_id": "KINDERKURS_A"}])
+        scraper.save_known_courses([{"course_id": "KINDERKURS_B"}])
+        assert [c["course_id"] for c in scraper.load_known_courses()] == ["KINDERKURS_A", "KINDERKURS_B"]
+        print("✓ Saving appends to the state file")
         
-        # Clean up test file
-        if test_state_file.exists():
-            test_state_file.unlink()
+        # An append cut short mid-line is followed by a fresh line
+        with open(scraper.state_file, 'ab') as f:
+            f.write(b'{"course_id": "KINDERK')
+        scraper.save_known_courses([{"course_id": "KINDERKURS_C"}])
+        lines = scraper.state_file.read_bytes().split(b'\n')
+        assert lines[-3:-1] == [b'{"course_id": "KINDERK', _json_line({"course_id": "KINDERKURS_C"}).rstrip(b'\n')]
+        print("✓ Truncated last line is repaired on the next append")
         
-        return True
+        # Invalid JSON and non-object records are skipped
+        with open(scraper.state_file, 'ab') as f:
+            f.write(b'[1]\n"text"\n\n{"course_id": "\xff"}\n{"course_id": "KINDERKURS_D"}\n')
+        assert len(scraper.load_known_courses()) == 4
         
-    except Exception as e:
-        print(f"✗ Test failed: {e}")
-        return False
+        # The ID loader used by run() sees the same courses
+        known_ids = scraper.load_known_course_ids()
+        assert known_ids == {"KINDERKURS_A", "KINDERKURS_B", "KINDERKURS_C", "KINDERKURS_D"}
+        assert scraper.find_new_courses([{"course_id": "KINDERKURS_A"}, {"course_id": "KINDERKURS_E"}]) == [
+            {"course_id": "KINDERKURS_E"}
+        ]
+        print("✓ Invalid, non-UTF-8 and non-object lines are skipped")
+
+class FakeGeminiModel:
+    """Stand-in for the Gemini model that returns a fixed answer and counts calls"""
+    
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = 0
+    
+    def generate_content(self, html_content):
+        self.calls += 1
+        part = SimpleNamespace(text=self.answer)
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+def test_gemini_cache():
+    """Test that unchanged HTML is served from the Gemini cache"""
+    print("\nTesting Gemini result cache...")
+    
+    scraper = get_scraper()
+    html = "<html><body><main>KINDERKURS_CACHE_01</main></body></html>"
+    model = FakeGeminiModel('```json\n[{"course_id": "KINDERKURS_CACHE_01"}]\n```')
+    
+    with temporary_state(scraper):
+        scraper.model = model
+        hits_before = scraper.gemini_cache_hits
+        
+        # Miss: Gemini is called and the result is stored
+        courses = scraper.parse_courses_with_gemini(html)
+        assert courses == [{"course_id": "KINDERKURS_CACHE_01"}]
+        assert model.calls == 1
+        print("✓ Cache miss calls Gemini")
+        
+        # Hit: Gemini is skipped and the entry's last use is refreshed
+        (html_hash, entry), = scraper.load_gemini_cache().items()
+        time.sleep(0.01)
+        assert scraper.parse_courses_with_gemini(html) == courses
+        assert model.calls == 1
+        assert scraper.gemini_cache_hits == hits_before + 1
+        assert scraper.load_gemini_cache()[html_hash]['last_used'] > entry['last_used']
+        print("✓ Cache hit skips Gemini and refreshes last use")
+        
+        # Changing the instructions or the model invalidates cached results
+        for name, value in (('_SYSTEM_INSTRUCTION', 'Changed instructions'), ('_GEMINI_MODEL', 'other-model')):
+            original = getattr(course_scraper, name)
+            setattr(course_scraper, name, value)
+            try:
+                calls_before = model.calls
+                assert scraper.parse_courses_with_gemini(html) == courses
+                assert model.calls == calls_before + 1
+            finally:
+                setattr(course_scraper, name, original)
+        print("✓ Prompt or model changes bypass cached results")
+        
+        # A corrupted entry falls back to calling Gemini
+        calls_before = model.calls
+        scraper.gemini_cache_file.write_bytes(_json_dumps({html_hash: {'last_used': time.time()}}))
+        assert scraper.parse_courses_with_gemini(html) == courses
+        assert model.calls == calls_before + 1
+        print("✓ Corrupted cache entry falls back to Gemini")
+        
+        # Entries unused for longer than the TTL are ignored
+        scraper.gemini_cache_file.write_bytes(_json_dumps({html_hash: {'courses': courses, 'last_used': 0}}))
+        assert scraper.load_gemini_cache() == {}
+        print("✓ Expired cache entries are ignored")
+
+class FakeSession:
+    """Stand-in for the HTTP session serving a fixed page, honouring If-None-Match"""
+    
+    def __init__(self, html, etag=None):
+        self.html = html
+        self.etag = etag
+        self.requests = []
+    
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append(headers or {})
+        response = requests.Response()
+        response.headers['Content-Type'] = 'text/html; charset=utf-8'
+        if self.etag and (headers or {}).get('If-None-Match') == self.etag:
+            response.status_code = 304
+            response._content = b''
+        else:
+            response.status_code = 200
+            response._content = self.html.encode('utf-8')
+            if self.etag:
+                response.headers['ETag'] = self.etag
+        return response
+
+def use_fake_backends(scraper, session, model):
+    """Swap in fake HTTP and Gemini backends (undone by temporary_state) and record notifications"""
+    notifications = []
+    scraper.session = session
+    scraper.model = model
+    scraper.send_notification = notifications.append
+    return notifications
+
+def test_conditional_fetch():
+    """Test that unchanged pages stop the run early unless the state was reset"""
+    print("\nTesting conditional fetch...")
+    
+    scraper = get_scraper()
+    html = "<html><body><main>KINDERKURS_HTTP_01</main></body></html>"
+    answer = '[{"course_id": "KINDERKURS_HTTP_01"}]'
+    
+    # Server with an ETag: the second run gets 304 Not Modified
+    model = FakeGeminiModel(answer)
+    session = FakeSession(html, etag='"v1"')
+    with temporary_state(scraper):
+        notifications = use_fake_backends(scraper, session, model)
+        assert scraper.run() is True
+        assert len(notifications) == 1
+        
+        assert scraper.run() is False
+        assert session.requests[-1].get('If-None-Match') == '"v1"'
+        assert model.calls == 1 and len(notifications) == 1
+        print("✓ HTTP 304 stops the run before Gemini")
+        
+        # Emptying the state file makes the next run treat all courses as new again
+        scraper.state_file.write_bytes(b'')
+        assert scraper.run() is True
+        assert 'If-None-Match' not in session.requests[-1]
+        assert len(notifications) == 2
+        print("✓ Resetting the state file bypasses the HTTP cache")
+    
+    # A corrupted HTTP cache is ignored instead of failing the run
+    for corrupted in (b'[]', b'null', b'"x"', b'{"etag'):
+        model = FakeGeminiModel(answer)
+        session = FakeSession(html, etag='"v1"')
+        with temporary_state(scraper):
+            notifications = use_fake_backends(scraper, session, model)
+            scraper.http_cache_file.write_bytes(corrupted)
+            assert scraper.run() is True
+            assert session.requests[-1] == {}
+            assert len(notifications) == 1
+    print("✓ Corrupted HTTP cache is ignored")
+    
+    # Server without validators: an identical body stops the run early
+    model = FakeGeminiModel(answer)
+    session = FakeSession(html)
+    with temporary_state(scraper):
+        notifications = use_fake_backends(scraper, session, model)
+        assert scraper.run() is True
+        assert scraper.run() is False
+        assert model.calls == 1 and len(notifications) == 1
+        print("✓ Unchanged page content stops the run before Gemini")
 
 def test_email_formatting():
     """Test email formatting without actually sending"""
@@ -102,61 +295,89 @@ def test_email_formatting():
         }
     ]
     
-    try:
-        scraper = CourseScraper(init_gemini=False)
-        
-        # Mock the send notification method to just format and print
-        def mock_send_notification(new_courses):
-            subject = f"🏊 New Swim Courses Available at Freizeitbad Molzberg ({len(new_courses)} found)"
-            
-            body = "New swim courses have been detected at Freizeitbad Molzberg!\n\n"
-            body += f"Website: {scraper.target_url}\n\n"
-            body += "New Courses:\n"
-            body += "=" * 50 + "\n\n"
-            
-            for i, course in enumerate(new_courses, 1):
-                body += f"{i}. Course ID: {course.get('course_id', 'Unknown Course')}\n"
-                if course.get('price'):
-                    body += f"   Price: {course['price']}\n"
-                if course.get('date_time'):
-                    body += f"   Schedule: {course['date_time']}\n"
-                if course.get('location'):
-                    body += f"   Location: {course['location']}\n"
-                if course.get('participants'):
-                    body += f"   Participants: {course['participants']}\n"
-                if course.get('booking_status'):
-                    body += f"   Booking: {course['booking_status']}\n"
-                if course.get('booking_link'):
-                    body += f"   Registration Form: {course['booking_link']}\n"
-                body += "\n"
-            
-            body += "\nPlease visit the website to register for the courses.\n"
-            body += "\n---\nThis is an automated notification from the Molzberg Monitor."
-            
-            print(f"Subject: {subject}")
-            print(f"Body:\n{body}")
-            return True
-        
-        mock_send_notification(test_courses)
-        print("✓ Email formatting works correctly")
-        return True
-        
-    except Exception as e:
-        print(f"✗ Email formatting test failed: {e}")
-        return False
+    scraper = get_scraper()
+    
+    # Render the email without sending it
+    subject = scraper._render_subject(test_courses)
+    body = scraper._render_body(test_courses)
+    print(f"Subject: {subject}")
+    print(f"Body:\n{body}")
+    
+    assert "(1 found)" in subject
+    assert f"Website: {scraper.target_url}" in body
+    assert "1. Course ID: KINDERKURS_MORNING_01\n" in body
+    assert "   Price: 40,00 €\n" in body
+    assert "   Registration Form: https://example.com/anmeldung_morning_01.pdf\n" in body
+    print("✓ Email formatting works correctly")
+
+def test_code_fence_stripping():
+    """Test removal of markdown code fences around Gemini answers"""
+    print("\nTesting code fence stripping...")
+    
+    cases = {
+        '```json\n[{"course_id": "A"}]\n```': '[{"course_id": "A"}]',
+        '```\n[{"course_id": "A"}]\n```': '[{"course_id": "A"}]',
+        '  ```json [{"course_id": "A"}]```  ': '[{"course_id": "A"}]',
+        '[{"course_id": "A"}]': '[{"course_id": "A"}]',
+        # Truncated answers without a closing fence are still unwrapped
+        '```json\n[{"course_id": "A"}]': '[{"course_id": "A"}]',
+        '```json\n[{"course_id": "A"}]\n': '[{"course_id": "A"}]',
+    }
+    for content, expected in cases.items():
+        assert _strip_code_fence(content).strip() == expected, content
+    print("✓ Code fences are stripped correctly")
+
+def test_course_html_extraction():
+    """Test trimming page HTML to the part that contains the courses"""
+    print("\nTesting course HTML extraction...")
+    
+    page = (
+        '<html><head><style>body {{}}</style><script>track()</script></head>'
+        '<body><nav>Menu</nav>{content}<footer>Impressum</footer></body></html>'
+    )
+    
+    # <main> is used without scripts, styles or inline graphics
+    html = _extract_course_html(page.format(
+        content='<main><script>x()</script><svg><path/></svg>'
+                '<p>KINDERKURS KSK01 <a href="anmeldung.pdf">PDF</a></p></main>'
+    ))
+    assert html == '<main><p>KINDERKURS KSK01 <a href="anmeldung.pdf">PDF</a></p></main>'
+    
+    # #content is used when there is no <main>
+    html = _extract_course_html(page.format(content='<div id="content"><p>KINDERKURS KSK02</p></div>'))
+    assert html == '<div id="content"><p>KINDERKURS KSK02</p></div>'
+    
+    # Empty or graphics-only containers fall back to the whole body
+    for content in ('<main></main><p>KINDERKURS KSK03</p>',
+                    '<main><svg><path/></svg></main><div id="content"> </div><p>KINDERKURS KSK03</p>'):
+        html = _extract_course_html(page.format(content=content))
+        assert html.startswith('<body>') and 'KINDERKURS KSK03' in html
+        assert 'track()' not in html
+    print("✓ Course HTML is extracted from the right container")
 
 def main():
     """Run all tests"""
     print("Running basic functionality tests for course scraper...\n")
     
+    tests = [
+        test_state_management,
+        test_known_courses_append_only,
+        test_gemini_cache,
+        test_conditional_fetch,
+        test_email_formatting,
+        test_code_fence_stripping,
+        test_course_html_extraction,
+    ]
     tests_passed = 0
-    total_tests = 2
+    total_tests = len(tests)
     
-    if test_state_management():
-        tests_passed += 1
-        
-    if test_email_formatting():
-        tests_passed += 1
+    # Tests signal failure by raising (so pytest sees it) or by returning False
+    for test in tests:
+        try:
+            if test() is not False:
+                tests_passed += 1
+        except Exception as e:
+            print(f"✗ {test.__name__} failed: {e!r}")
     
     print(f"\nTest Results: {tests_passed}/{total_tests} tests passed")
     